@@ -9,17 +9,27 @@ Usage:
 """
 
 import argparse
-import datetime
-import http.server
+import concurrent.futures
+import errno
+import functools
+import hashlib
+import importlib.util
+import itertools
 import json
+import mmap
 import os
 import platform
+import re
 import shutil
-import socketserver
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import uuid
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Optional, Tuple
 
 # =============================================================================
@@ -36,7 +46,23 @@ MEDIA_DIR = MEDIA_DIR_CANDIDATE if MEDIA_DIR_CANDIDATE.exists() else Path("media
 
 CONFIG_FILE = BASE_DIR / "config.json"
 
+# Resolved once; platform.uname() is cached but processor() may fork
+PLATFORM_SYSTEM = platform.system()
+PLATFORM_MACHINE = platform.machine()
+IS_APPLE_SILICON = PLATFORM_SYSTEM == "Darwin" and PLATFORM_MACHINE == "arm64"
+
+# Local state that survives between runs (context cache registry, etc.)
+CACHE_DIR = Path.home() / ".cache" / "open-vtt"
+CONTEXT_CACHE_FILE = CACHE_DIR / "caches.json"
+CONTEXT_CACHE_TTL = 3600  # seconds
+UPLOAD_CACHE_FILE = CACHE_DIR / "uploads.json"
+UPLOAD_CACHE_TTL = 47 * 3600  # Gemini keeps uploaded files for 48h
+FFPROBE_CACHE_FILE = CACHE_DIR / "ffprobe.json"
+FFPROBE_CACHE_MAX = 256  # entries
+FFPROBE_CACHE_VERSION = 3  # bump when ffprobe_check's metadata changes meaning
+
 # Load config with defaults
+@functools.lru_cache(maxsize=1)
 def load_config():
     """Load configuration from config.json with sensible defaults."""
     config = {
@@ -85,6 +111,9 @@ def load_config():
 
 CONFIG = load_config()
 
+# Attribute view of CONFIG for hot paths: CFG.gemini.temperature
+CFG = json.loads(json.dumps(CONFIG), object_hook=lambda d: SimpleNamespace(**d))
+
 # Convenience accessors
 MAX_SIZE_MB = CONFIG["video"]["max_size_mb"]
 DOWNSAMPLE_TARGETS = CONFIG["video"]["downsample_targets"]
@@ -95,34 +124,55 @@ PROMPT_FILE = CONFIG["files"]["prompt"]
 # OPTIONAL IMPORTS
 # =============================================================================
 
-HAS_MLX_WHISPER = False
-HAS_WHISPER = False
-HAS_GENAI = False
-
-try:
-    import mlx_whisper
-    HAS_MLX_WHISPER = True
-except ImportError:
-    pass
-
-try:
-    import whisper
-    HAS_WHISPER = True
-except ImportError:
-    pass
-
-try:
-    from google import genai
-    from google.genai import types
-    HAS_GENAI = True
-    GENAI_NEW = True
-except ImportError:
+# Availability is probed with find_spec, which locates a module without
+# executing it; the heavy imports (torch, mlx, google-genai) happen on use.
+
+def has_module(name: str) -> bool:
+    """Check whether a module is installed without importing it."""
     try:
-        import google.generativeai as genai
-        HAS_GENAI = True
-        GENAI_NEW = False
-    except ImportError:
-        pass
+        return importlib.util.find_spec(name) is not None
+    except ImportError:  # Parent package (e.g. google) is missing
+        return False
+
+
+HAS_MLX_WHISPER = has_module("mlx_whisper")
+HAS_FASTER_WHISPER = has_module("faster_whisper")
+HAS_WHISPERCPP = has_module("pywhispercpp")
+HAS_WHISPER = has_module("whisper")
+HAS_NUMPY = has_module("numpy")
+GENAI_NEW = has_module("google.genai")
+HAS_GENAI = GENAI_NEW or has_module("google.generativeai")
+
+
+@functools.lru_cache(maxsize=1)
+def import_genai():
+    """
+    Import the installed Gemini SDK, falling back to the legacy SDK if
+    google.genai is installed but fails to import.
+    Returns (genai, types); types is None for the legacy SDK.
+    """
+    if GENAI_NEW:
+        try:
+            from google import genai
+            from google.genai import types
+            return genai, types
+        except ImportError as e:
+            if not has_module("google.generativeai"):
+                raise
+            log_warning(f"google-genai failed to import ({e}), using google-generativeai")
+    import google.generativeai as genai
+    return genai, None
+
+
+@functools.lru_cache(maxsize=None)
+def get_genai_client(api_key: str):
+    """
+    Shared google.genai client per API key. Upload, context caching and
+    generation reuse its HTTP connection pool instead of each opening new
+    TCP/TLS connections.
+    """
+    genai, _ = import_genai()
+    return genai.Client(api_key=api_key)
 
 # =============================================================================
 # UTILITIES
@@ -152,11 +202,12 @@ def log_subtitle(msg: str):
 def log_ai(msg: str):
     print(f"🤖 {msg}")
 
-def estimate_cost(model: str, input_tok: int, output_tok: int) -> float:
+def estimate_cost(model: str, input_tok: int, output_tok: int, cached_tok: int = 0) -> float:
     """Estimate cost based on Gemini API pricing (Jan 2025)."""
     # Gemini 3 Pro: $2.00/$12.00 per 1M (≤200k context), $4.00/$18.00 (>200k)
     # Gemini 1.5 Pro: $3.50/$10.50 per 1M
     # Gemini Flash: $0.075/$0.30 per 1M
+    # Cached input tokens bill at ~10% of the base input rate
     
     model_lower = model.lower()
     
@@ -169,24 +220,78 @@ def estimate_cost(model: str, input_tok: int, output_tok: int) -> float:
         # Default to 1.5 Pro pricing
         rates = {"in": 3.50, "out": 10.50}
         
-    cost = (input_tok / 1_000_000 * rates["in"]) + (output_tok / 1_000_000 * rates["out"])
+    fresh_tok = input_tok - cached_tok
+    cost = (
+        (fresh_tok / 1_000_000 * rates["in"])
+        + (cached_tok / 1_000_000 * rates["in"] * 0.1)
+        + (output_tok / 1_000_000 * rates["out"])
+    )
     return cost
 
 
+OUTPUT_TAIL_BYTES = 64 * 1024  # stderr kept from long-running commands
+
+# ffmpeg otherwise rewrites a progress line on stderr several times a second
+# for the whole encode; warnings and errors are all run_command callers report
+FFMPEG_LOG_ARGS = ("-hide_banner", "-nostats", "-loglevel", "warning")
+
+
+def _drain_pipe(stream, sink: bytearray, limit: Optional[int] = None):
+    """Read a pipe until EOF, keeping only the last `limit` bytes if set."""
+    for chunk in iter(lambda: stream.read1(64 * 1024), b""):
+        sink += chunk
+        if limit and len(sink) > limit:
+            del sink[:-limit]
+    stream.close()
+
+
 def run_command(cmd: list, capture: bool = True) -> Tuple[int, str, str]:
-    """Run a command and return (returncode, stdout, stderr)."""
+    """
+    Run a command and return (returncode, stdout, stderr).
+    Output is streamed rather than buffered; only the tail of stderr is
+    kept since ffmpeg writes progress there for the whole encode.
+    """
+    pipe = subprocess.PIPE if capture else None
     try:
-        result = subprocess.run(
-            cmd,
-            capture_output=capture,
-            text=True,
-            timeout=3600  # 1 hour timeout for long operations
-        )
-        return result.returncode, result.stdout, result.stderr
+        proc = subprocess.Popen(cmd, stdout=pipe, stderr=pipe)
     except FileNotFoundError:
         return -1, "", f"Command not found: {cmd[0]}"
+    
+    stdout, stderr = bytearray(), bytearray()
+    readers = []
+    if capture:
+        readers = [
+            threading.Thread(target=_drain_pipe, args=(proc.stdout, stdout), daemon=True),
+            threading.Thread(target=_drain_pipe, args=(proc.stderr, stderr, OUTPUT_TAIL_BYTES), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+    
+    try:
+        proc.wait(timeout=3600)  # 1 hour timeout for long operations
     except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
         return -2, "", "Command timed out"
+    finally:
+        for reader in readers:
+            reader.join()
+    
+    return (
+        proc.returncode,
+        stdout.decode("utf-8", errors="replace"),
+        stderr.decode("utf-8", errors="replace")
+    )
+
+
+def resolve_first_existing(candidates: list) -> Optional[Tuple[Path, os.stat_result]]:
+    """Return (path, stat) for the first candidate that exists, or None."""
+    for candidate in candidates:
+        try:
+            return candidate, os.stat(candidate)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return None
 
 
 def get_file_size_mb(path: Path) -> float:
@@ -194,14 +299,196 @@ def get_file_size_mb(path: Path) -> float:
     return path.stat().st_size / (1024 * 1024)
 
 
+HASH_CHUNK_BYTES = 4 << 20  # read size when hashing videos without file_digest
+
+
+@functools.lru_cache(maxsize=16)
+def _file_sha256(path_str: str, mtime_ns: int, size: int) -> str:
+    # Unbuffered: reads go straight into the digest buffer, not via BufferedReader
+    with open(path_str, "rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        buf = bytearray(HASH_CHUNK_BYTES)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+        return digest.hexdigest()
+
+
+def file_sha256(path: Path) -> str:
+    """Compute the sha256 hex digest of a file (memoized per path and mtime)."""
+    st = path.stat()
+    return _file_sha256(str(path), st.st_mtime_ns, st.st_size)
+
+
+def open_dir(directory: Path) -> Optional[int]:
+    """
+    Open a directory for dir_fd-relative file calls (openat/linkat/unlinkat),
+    so repeated creates in it skip the full path lookup. Returns None where
+    that isn't supported (e.g. Windows); callers then fall back to paths.
+    """
+    if not hasattr(os, "O_DIRECTORY") or not {os.open, os.link, os.unlink} <= os.supports_dir_fd:
+        return None
+    return os.open(str(directory), os.O_RDONLY | os.O_DIRECTORY)
+
+
+def write_temp_file(directory: Path, stem: str, data, dir_fd: Optional[int] = None) -> str:
+    """
+    Write bytes (or any buffer, e.g. an mmap slice) to a new, fsynced temp
+    file in directory. Returns its name relative to dir_fd (open_dir of
+    directory) when given, else its full path.
+    """
+    tmp_name = f"{stem}.{uuid.uuid4().hex[:8]}.tmp"
+    tmp = tmp_name if dir_fd is not None else str(directory / tmp_name)
+    
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644, dir_fd=dir_fd)
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(tmp, dir_fd=dir_fd)
+        raise
+    return tmp
+
+
+def atomic_write_bytes(path: Path, data):
+    """
+    Write bytes via a sibling temp file and os.replace, so readers (e.g.
+    --serve) see either the old file or the complete new one, never a
+    partial write.
+    """
+    tmp = write_temp_file(path.parent, path.stem, data)
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def atomic_write_text(path: Path, data: str):
+    """Write text atomically (see atomic_write_bytes)."""
+    atomic_write_bytes(path, data.encode("utf-8"))
+
+
+def load_json_cache(path: Path) -> dict:
+    """Load a JSON cache file, returning an empty dict if missing or corrupt."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError):
+        return {}
+
+
+def save_json_cache(path: Path, data: dict):
+    """Save a JSON cache file, ignoring write errors (caches are best-effort)."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(path, json.dumps(data, indent=2))
+    except IOError as e:
+        log_warning(f"Could not write cache {path.name}: {e}")
+
+
+# Zero-padded field strings, so to_vtt_time indexes instead of formatting
+_PAD2 = [f"{i:02d}" for i in range(100)]
+_PAD3 = [f"{i:03d}" for i in range(1000)]
+
+
 def to_vtt_time(seconds: float) -> str:
     """Format seconds into WebVTT timestamp: HH:MM:SS.mmm"""
-    td = datetime.timedelta(seconds=seconds)
-    total_seconds = int(td.total_seconds())
-    hours, remainder = divmod(total_seconds, 3600)
-    minutes, secs = divmod(remainder, 60)
-    milliseconds = int((seconds - int(seconds)) * 1000)
-    return f"{hours:02}:{minutes:02}:{secs:02}.{milliseconds:03}"
+    # Single integer division chain; rounding once avoids 1.001 -> .000
+    ms = int(round(seconds * 1000))
+    hours, ms = divmod(ms, 3_600_000)
+    minutes, ms = divmod(ms, 60_000)
+    secs, ms = divmod(ms, 1000)
+    if 0 <= hours < 100:
+        return f"{_PAD2[hours]}:{_PAD2[minutes]}:{_PAD2[secs]}.{_PAD3[ms]}"
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{ms:03d}"
+
+
+def to_vtt_time_batch(seconds) -> list:
+    """Format a sequence of seconds as WebVTT timestamps, vectorized with NumPy if installed."""
+    if not HAS_NUMPY or len(seconds) == 0:
+        return [to_vtt_time(s) for s in seconds]
+    
+    import numpy as np
+    
+    ms = np.rint(np.asarray(seconds, dtype=np.float64) * 1000).astype(np.int64)
+    hours, ms = np.divmod(ms, 3_600_000)
+    if hours.max() >= 100 or hours.min() < 0:
+        return [to_vtt_time(s) for s in seconds]  # Doesn't fit HH:MM:SS.mmm
+    minutes, ms = np.divmod(ms, 60_000)
+    secs, ms = np.divmod(ms, 1000)
+    
+    # Write ASCII digits straight into an (n, 12) byte matrix: HH:MM:SS.mmm
+    buf = np.empty((len(ms), 12), dtype=np.uint8)
+    buf[:, [2, 5]] = ord(":")
+    buf[:, 8] = ord(".")
+    for col, values in ((0, hours), (3, minutes), (6, secs)):
+        buf[:, col] = values // 10 + 48
+        buf[:, col + 1] = values % 10 + 48
+    buf[:, 9] = ms // 100 + 48
+    buf[:, 10] = ms // 10 % 10 + 48
+    buf[:, 11] = ms % 10 + 48
+    return buf.view("S12").ravel().astype("U12").tolist()
+
+
+# VTT block in a model response: from WEBVTT to the closing fence (or end)
+VTT_RE = re.compile(r"(WEBVTT\b.*?)(?:\n```|\Z)", re.DOTALL)
+VTT_BYTES_RE = re.compile(rb"(WEBVTT\b.*?)(?:\n```|\Z)", re.DOTALL)
+
+
+def extract_vtt(text):
+    """
+    Extract the VTT portion from a Gemini response, or the full text if none.
+    Accepts str or a bytes-like buffer (bytes, mmap) and matches it in place.
+    """
+    pattern = VTT_RE if isinstance(text, str) else VTT_BYTES_RE
+    match = pattern.search(text)
+    return match.group(1).strip() if match else text
+
+
+def write_segments_vtt(segments, output_path: Path):
+    """Write transcription segments (dicts with start/end/text) as WebVTT."""
+    segments = list(segments)
+    starts = to_vtt_time_batch([seg["start"] for seg in segments])
+    ends = to_vtt_time_batch([seg["end"] for seg in segments])
+    
+    parts = ["WEBVTT\n\n"]
+    parts.extend(
+        f"{start} --> {end}\n{seg['text'].strip()}\n\n"
+        for start, end, seg in zip(starts, ends, segments)
+    )
+    output_path.write_text("".join(parts), encoding="utf-8")
+
+
+def timed(func, *args):
+    """Call func(*args) and return (result, elapsed seconds)."""
+    start = time.monotonic()
+    result = func(*args)
+    return result, time.monotonic() - start
+
+
+def run_in_background(func, *args) -> concurrent.futures.Future:
+    """
+    Run func(*args) on a daemon thread and return a Future for its result.
+    Unlike an executor, an abandoned task doesn't keep the process alive.
+    """
+    future = concurrent.futures.Future()
+    
+    def runner():
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=runner, daemon=True).start()
+    return future
 
 
 # =============================================================================
@@ -249,6 +536,20 @@ def check_command(name: str, cmd: list) -> bool:
         return False
 
 
+def get_cpu_name() -> str:
+    """Get the CPU model name, reading /proc/cpuinfo on Linux instead of forking uname."""
+    if PLATFORM_SYSTEM != "Linux":
+        return platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return ""
+
+
 def cmd_check():
     """Check system dependencies and hardware."""
     print(f"\n{APP_NAME} System Check\n" + "=" * 40)
@@ -262,10 +563,14 @@ def cmd_check():
     # Whisper
     if HAS_MLX_WHISPER:
         log_success("mlx-whisper: available (Apple Silicon optimized)")
+    elif HAS_FASTER_WHISPER:
+        log_success("faster-whisper: available (CTranslate2 int8)")
+    elif HAS_WHISPERCPP:
+        log_success("whisper.cpp: available (pywhispercpp, GGML quantized)")
     elif HAS_WHISPER:
-        log_warning("whisper (OpenAI): available, but mlx-whisper is faster on Apple Silicon")
+        log_warning("whisper (OpenAI): available, but faster-whisper (or mlx-whisper on Apple Silicon) is faster")
     else:
-        log_error("whisper: not installed (pip install mlx-whisper or openai-whisper)")
+        log_error("whisper: not installed (pip install mlx-whisper, faster-whisper or openai-whisper)")
         all_ok = False
     
     # Gemini SDK
@@ -285,14 +590,18 @@ def cmd_check():
         log_warning("GEMINI_API_KEY: not configured (required for --convert)")
     
     # Hardware
-    processor = platform.processor()
-    machine = platform.machine()
-    system = platform.system()
+    processor = get_cpu_name()
     
-    if system == "Darwin" and machine == "arm64":
+    if IS_APPLE_SILICON:
         log_success(f"Hardware: {processor} (Apple Silicon - Metal acceleration available)")
     else:
-        log_info(f"Hardware: {processor} ({system} {machine})")
+        log_info(f"Hardware: {processor} ({PLATFORM_SYSTEM} {PLATFORM_MACHINE})")
+    
+    encoder = select_video_encoders()[0]
+    if encoder == "libx264":
+        log_info("Video encoder: libx264 (software)")
+    else:
+        log_success(f"Video encoder: {encoder} (hardware)")
     
     # Python
     py_version = f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}"
@@ -314,45 +623,172 @@ def cmd_check():
 # SERVE MODE
 # =============================================================================
 
-class OpenVTTHandler(http.server.SimpleHTTPRequestHandler):
-    """Custom HTTP handler with /api/files endpoint."""
+BYTE_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range HTTP Range header into inclusive (start, end).
+    Returns None if the header isn't a simple, valid byte range (serve the
+    whole file, RFC 7233 2.1), raises ValueError if it starts past the end.
+    """
+    match = BYTE_RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None  # Invalid, not unsatisfiable
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+@functools.lru_cache(maxsize=1)
+def serve_classes():
+    """
+    Define the HTTP handler and server classes on first use, so only serve
+    mode pays for importing http.server (~25ms, a third of startup).
+    Returns (OpenVTTHandler, OpenVTTServer).
+    """
+    import http.server
     
-    def do_GET(self):
-        if self.path == "/":
-            self.path = "/player.html"
-            
-        super().do_GET()
+    class OpenVTTHandler(http.server.SimpleHTTPRequestHandler):
+        """Custom HTTP handler with /api/files endpoint."""
     
-
+        def setup(self):
+            super().setup()
+            # Small API/VTT responses shouldn't wait on Nagle's algorithm
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+        def do_GET(self):
+            if self.path == "/":
+                self.path = "/player.html"
+            
+            super().do_GET()
+    
+        def send_head(self):
+            """Handle Range requests (206) so players can seek in large videos."""
+            self.byte_range = None
+            range_header = self.headers.get("Range")
+            path = self.translate_path(self.path)
+            self.accept_ranges = os.path.isfile(path)
+            if not range_header or not os.path.isfile(path):
+                return super().send_head()
+        
+            try:
+                f = open(path, "rb")
+            except OSError:
+                return super().send_head()
+        
+            st = os.fstat(f.fileno())
+            try:
+                byte_range = parse_byte_range(range_header, st.st_size)
+            except ValueError:
+                f.close()
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{st.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+        
+            if byte_range is None:
+                f.close()
+                return super().send_head()
+        
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Range", f"bytes {start}-{end}/{st.st_size}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+            self.end_headers()
+            self.byte_range = byte_range
+            return f
+    
+        def end_headers(self):
+            # Advertise seeking on every file response, including full 200s
+            if getattr(self, "accept_ranges", False):
+                self.send_header("Accept-Ranges", "bytes")
+                self.accept_ranges = False
+            super().end_headers()
+    
+        def copyfile(self, source, outputfile):
+            """Send files to the client with zero-copy sendfile where available."""
+            offset, count = 0, None
+            if getattr(self, "byte_range", None):
+                start, end = self.byte_range
+                offset, count = start, end - start + 1
+        
+            if outputfile is self.wfile:
+                # socket.sendfile uses os.sendfile and falls back to send()
+                self.connection.sendfile(source, offset, count)
+            elif count is not None:
+                source.seek(offset)
+                outputfile.write(source.read(count))
+            else:
+                super().copyfile(source, outputfile)
     
-    def log_message(self, format, *args):
-        # Quieter logging
-        # args[0] might be status code (int) not string, ignore if so or convert
-        if len(args) > 0 and isinstance(args[0], str) and "/api/files" in args[0]:
-            return
+        def log_message(self, format, *args):
+            # Quieter logging
+            # args[0] might be status code (int) not string, ignore if so or convert
+            if len(args) > 0 and isinstance(args[0], str) and "/api/files" in args[0]:
+                return
         
-        # Default logging format matching SimpleHTTPRequestHandler
-        log_info(f"[serve] {format % args}")
+            # Default logging format matching SimpleHTTPRequestHandler
+            log_info(f"[serve] {format % args}")
             
-    def translate_path(self, path):
-        """Custom path translation to serve media files."""
-        from urllib.parse import unquote
-        path = unquote(path)  # Decode %20 -> space, etc.
+        def translate_path(self, path):
+            """Custom path translation to serve media files."""
+            from urllib.parse import unquote
+            path = unquote(path)  # Decode %20 -> space, etc.
         
-        # If user requests /media/filename.mp4, serve it from MEDIA_DIR
-        if path.startswith("/media/"):
-            rest = path.replace("/media/", "")
-            return str(MEDIA_DIR / rest)
+            # If user requests /media/filename.mp4, serve it from MEDIA_DIR
+            if path.startswith("/media/"):
+                rest = path.replace("/media/", "")
+                return str(MEDIA_DIR / rest)
         
-        # If user requests a video file directly at root (for backward compat or simple names)
-        # Check if it exists in media dir
-        path_clean = path.lstrip('/')
-        media_path = MEDIA_DIR / path_clean
-        if media_path.exists() and not path_clean.endswith(".html"):
-             return str(media_path)
+            # If user requests a video file directly at root (for backward compat or simple names)
+            # Check if it exists in media dir
+            path_clean = path.lstrip('/')
+            media_path = MEDIA_DIR / path_clean
+            if media_path.exists() and not path_clean.endswith(".html"):
+                 return str(media_path)
+
+            # Otherwise rely on default SimpleHTTPRequestHandler (serves CWD = BASE_DIR usually)
+            return super().translate_path(path)
+    
+    
+    class OpenVTTServer(http.server.ThreadingHTTPServer):
+        """Threaded server so a long video stream doesn't block VTT requests."""
+        daemon_threads = True
+        allow_reuse_address = True
+        request_queue_size = 64
+    
+    return OpenVTTHandler, OpenVTTServer
+
 
-        # Otherwise rely on default SimpleHTTPRequestHandler (serves CWD = BASE_DIR usually)
-        return super().translate_path(path)
+def list_media_files(directory: Path = MEDIA_DIR) -> Tuple[list, list]:
+    """List (videos, vtts) file names in directory with a single directory scan."""
+    videos, vtts = [], []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file():  # Follows symlinks, so linked-in videos are listed
+                    continue
+                if entry.name.endswith(".mp4"):
+                    videos.append(entry.name)
+                elif entry.name.endswith(".vtt"):
+                    vtts.append(entry.name)
+    except FileNotFoundError:
+        pass  # No media dir yet
+    return videos, vtts
 
 
 def cmd_serve(port: int = 8000):
@@ -366,15 +802,15 @@ def cmd_serve(port: int = 8000):
     os.chdir(BASE_DIR)
 
     # Count files
-    videos = list(MEDIA_DIR.glob("*.mp4"))
-    vtts = list(MEDIA_DIR.glob("*.vtt"))
+    videos, vtts = list_media_files()
     
     print(f"\n{APP_NAME} Server\n" + "=" * 40)
     log_info(f"Found {len(videos)} video(s) and {len(vtts)} VTT file(s)")
     log_info(f"Serving at http://localhost:{port}")
     log_info("Press Ctrl+C to stop\n")
     
-    with socketserver.TCPServer(("", port), OpenVTTHandler) as httpd:
+    OpenVTTHandler, OpenVTTServer = serve_classes()
+    with OpenVTTServer(("", port), OpenVTTHandler) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -386,20 +822,50 @@ def cmd_serve(port: int = 8000):
 # CONVERT MODE - FFPROBE
 # =============================================================================
 
-def ffprobe_check(video_path: Path) -> dict:
-    """Check video health and get metadata."""
+def stream_rotation(stream: dict) -> int:
+    """Rotation in degrees from display matrix side data, or the legacy rotate tag."""
+    for side_data in stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            return int(float(side_data["rotation"]))
+    return int(stream.get("tags", {}).get("rotate", 0))
+
+
+def display_size(width: int, height: int, rotation: int) -> Tuple[int, int]:
+    """Frame size after ffmpeg's autorotation: quarter turns swap width and height."""
+    if rotation % 180 == 90:
+        return height, width
+    return width, height
+
+
+def ffprobe_check(video_path: Path, st: Optional[os.stat_result] = None) -> dict:
+    """
+    Check video health and get metadata.
+    Results are cached by (path, mtime, size) so re-runs skip ffprobe.
+    Pass st to reuse a stat the caller already has.
+    """
     log_video(f"Checking video: {video_path.name}")
     
+    if st is None:
+        st = video_path.stat()
+    cache_key = f"v{FFPROBE_CACHE_VERSION}|{video_path.resolve()}|{st.st_mtime_ns}|{st.st_size}"
+    probe_cache = load_json_cache(FFPROBE_CACHE_FILE)
+    metadata = probe_cache.get(cache_key)
+    if metadata:
+        log_success(f"Duration: {metadata['duration']:.1f}s, Size: {metadata['size_mb']:.1f}MB, Audio: {metadata['has_audio']}, Subtitles: {metadata['subtitle_codec'] or metadata['has_subtitles']} (cached)")
+        return metadata
+    
+    # Only ask for the fields we use; the full dump can be 100KB of JSON.
     cmd = [
-        "ffprobe", "-v", "quiet",
+        "ffprobe", "-v", "error",
         "-print_format", "json",
-        "-show_format", "-show_streams",
+        "-show_entries",
+        "format=duration:stream=codec_type,codec_name,width,height:stream_tags=rotate:stream_side_data=rotation",
         str(video_path)
     ]
     
     code, stdout, stderr = run_command(cmd)
     if code != 0:
-        log_error(f"ffprobe failed: {stderr}")
+        log_error(f"ffprobe failed: {stderr.strip()}")
         return {}
     
     try:
@@ -407,46 +873,108 @@ def ffprobe_check(video_path: Path) -> dict:
         
         # Extract useful info
         duration = float(data.get("format", {}).get("duration", 0))
-        size_mb = get_file_size_mb(video_path)
+        size_mb = st.st_size / (1024 * 1024)
         
         # Find subtitle and audio streams
         has_subtitles = False
         has_audio = False
+        subtitle_codec = None
+        width = height = 0
         for stream in data.get("streams", []):
+            if stream.get("codec_type") == "video" and not width:
+                # ffprobe reports the coded size; ffmpeg filters see it rotated
+                width, height = display_size(
+                    stream.get("width", 0), stream.get("height", 0), stream_rotation(stream)
+                )
             if stream.get("codec_type") == "subtitle":
+                if not has_subtitles:
+                    subtitle_codec = stream.get("codec_name")
                 has_subtitles = True
             if stream.get("codec_type") == "audio":
                 has_audio = True
         
-        log_success(f"Duration: {duration:.1f}s, Size: {size_mb:.1f}MB, Audio: {has_audio}, Subtitles: {has_subtitles}")
+        log_success(f"Duration: {duration:.1f}s, Size: {size_mb:.1f}MB, Audio: {has_audio}, Subtitles: {subtitle_codec or has_subtitles}")
         
-        return {
+        metadata = {
             "duration": duration,
             "size_mb": size_mb,
+            "width": width,
+            "height": height,
             "has_audio": has_audio,
             "has_subtitles": has_subtitles,
+            "subtitle_codec": subtitle_codec,
             "data": data
         }
     except json.JSONDecodeError:
         log_error("Failed to parse ffprobe output")
         return {}
+    
+    probe_cache[cache_key] = metadata
+    for stale_key in list(probe_cache)[:-FFPROBE_CACHE_MAX]:
+        del probe_cache[stale_key]
+    save_json_cache(FFPROBE_CACHE_FILE, probe_cache)
+    
+    return metadata
 
 
 # =============================================================================
 # CONVERT MODE - SUBTITLE EXTRACTION
 # =============================================================================
 
-def extract_subtitles(video_path: Path, output_path: Path) -> bool:
-    """Extract embedded subtitles using ffmpeg."""
+SRT_TIMESTAMP_RE = re.compile(r"(\d{2}:\d{2}:\d{2}),(\d{3})")
+
+
+def srt_to_vtt(srt_text: str) -> str:
+    """Convert SubRip (SRT) text to WebVTT."""
+    text = srt_text.lstrip("\ufeff").replace("\r\n", "\n").replace("\r", "\n")
+    
+    lines = []
+    for line in text.split("\n"):
+        # Only timing lines use the comma decimal separator
+        if "-->" in line:
+            line = SRT_TIMESTAMP_RE.sub(r"\1.\2", line)
+        lines.append(line)
+    
+    return "WEBVTT\n\n" + "\n".join(lines).strip() + "\n"
+
+
+def extract_subtitles(video_path: Path, output_path: Path, codec: Optional[str] = None) -> bool:
+    """
+    Extract embedded subtitles using ffmpeg.
+    WebVTT and SRT streams are stream-copied (SRT is converted in-process);
+    other text formats are converted by ffmpeg.
+    """
     log_subtitle(f"Extracting embedded subtitles to {output_path.name}")
     
-    cmd = [
-        "ffmpeg", "-y", "-i", str(video_path),
-        "-map", "0:s:0", "-c:s", "webvtt",
-        str(output_path)
-    ]
+    srt_path = None
+    if codec == "webvtt":
+        cmd = [
+            "ffmpeg", *FFMPEG_LOG_ARGS, "-y", "-i", str(video_path),
+            "-map", "0:s:0", "-c:s", "copy",
+            str(output_path)
+        ]
+    elif codec == "subrip":
+        srt_path = output_path.with_suffix(".srt")
+        cmd = [
+            "ffmpeg", *FFMPEG_LOG_ARGS, "-y", "-i", str(video_path),
+            "-map", "0:s:0", "-c:s", "copy",
+            str(srt_path)
+        ]
+    else:
+        cmd = [
+            "ffmpeg", *FFMPEG_LOG_ARGS, "-y", "-i", str(video_path),
+            "-map", "0:s:0", "-c:s", "webvtt",
+            str(output_path)
+        ]
     
     code, stdout, stderr = run_command(cmd)
+    if code == 0 and srt_path and srt_path.exists():
+        try:
+            srt_text = srt_path.read_text(encoding="utf-8", errors="replace")
+            output_path.write_text(srt_to_vtt(srt_text), encoding="utf-8")
+        finally:
+            srt_path.unlink()
+    
     if code == 0 and output_path.exists():
         log_success(f"Extracted subtitles: {output_path.name}")
         return True
@@ -456,157 +984,468 @@ def extract_subtitles(video_path: Path, output_path: Path) -> bool:
 
 
 def transcribe_with_whisper(video_path: Path, output_path: Path) -> bool:
-    """Transcribe video using mlx-whisper or whisper."""
+    """Transcribe video using mlx-whisper, faster-whisper, whisper.cpp or whisper."""
     log_subtitle(f"Transcribing audio with Whisper...")
     
+    # Installed doesn't mean importable (e.g. broken native deps): on
+    # ImportError, fall through to the next available backend
     if HAS_MLX_WHISPER:
-        log_info("Using mlx-whisper (Apple Silicon optimized)")
         try:
-            language = CONFIG.get("transcription", {}).get("language", "en")
-            log_info(f"Language: {language}")
-            result = mlx_whisper.transcribe(
-                str(video_path),
-                path_or_hf_repo="mlx-community/whisper-large-v3-turbo",
-                language=language,
-                verbose=False
-            )
-            
-            with open(output_path, "w", encoding="utf-8") as vtt:
-                vtt.write("WEBVTT\n\n")
-                for segment in result.get("segments", []):
-                    start = to_vtt_time(segment["start"])
-                    end = to_vtt_time(segment["end"])
-                    text = segment["text"].strip()
-                    vtt.write(f"{start} --> {end}\n{text}\n\n")
-            
-            log_success(f"Transcribed: {output_path.name}")
-            return True
-        except Exception as e:
-            log_error(f"mlx-whisper failed: {e}")
-            return False
+            import mlx_whisper
+        except ImportError as e:
+            log_warning(f"mlx-whisper failed to import ({e}), trying next backend")
+        else:
+            log_info("Using mlx-whisper (Apple Silicon optimized)")
+            try:
+                language = CFG.transcription.language
+                log_info(f"Language: {language}")
+                result = mlx_whisper.transcribe(
+                    str(video_path),
+                    path_or_hf_repo="mlx-community/whisper-large-v3-turbo",
+                    language=language,
+                    verbose=False
+                )
+                
+                write_segments_vtt(result.get("segments", []), output_path)
+                
+                log_success(f"Transcribed: {output_path.name}")
+                return True
+            except Exception as e:
+                log_error(f"mlx-whisper failed: {e}")
+                return False
     
-    elif HAS_WHISPER:
-        log_info("Using openai-whisper")
+    if HAS_FASTER_WHISPER:
         try:
-            language = CONFIG.get("transcription", {}).get("language", "en")
-            log_info(f"Language: {language}")
-            model = whisper.load_model("base")
-            result = model.transcribe(str(video_path), language=language)
-            
-            with open(output_path, "w", encoding="utf-8") as vtt:
-                vtt.write("WEBVTT\n\n")
-                for segment in result.get("segments", []):
-                    start = to_vtt_time(segment["start"])
-                    end = to_vtt_time(segment["end"])
-                    text = segment["text"].strip()
-                    vtt.write(f"{start} --> {end}\n{text}\n\n")
-            
-            log_success(f"Transcribed: {output_path.name}")
+            import ctranslate2
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            log_warning(f"faster-whisper failed to import ({e}), trying next backend")
+        else:
+            log_info("Using faster-whisper (CTranslate2 int8)")
+            try:
+                language = CFG.transcription.language
+                log_info(f"Language: {language}")
+                on_cuda = ctranslate2.get_cuda_device_count() > 0
+                model = WhisperModel(
+                    "large-v3-turbo",
+                    device="cuda" if on_cuda else "cpu",
+                    compute_type="int8_float16" if on_cuda else "int8"
+                )
+                # VAD filter skips silent stretches instead of decoding them
+                segments, info = model.transcribe(
+                    str(video_path),
+                    language=language,
+                    vad_filter=True,
+                    beam_size=1
+                )
+                
+                write_segments_vtt(
+                    ({"start": seg.start, "end": seg.end, "text": seg.text} for seg in segments),
+                    output_path
+                )
+                
+                log_success(f"Transcribed: {output_path.name}")
+                return True
+            except Exception as e:
+                log_error(f"faster-whisper failed: {e}")
+                return False
+    
+    if HAS_WHISPERCPP:
+        try:
+            from pywhispercpp.model import Model as WhisperCppModel
+        except ImportError as e:
+            log_warning(f"whisper.cpp failed to import ({e}), trying next backend")
+        else:
+            log_info("Using whisper.cpp (GGML quantized)")
+            try:
+                language = CFG.transcription.language
+                log_info(f"Language: {language}")
+                model = WhisperCppModel("large-v3-turbo-q5_0", n_threads=os.cpu_count())
+                segments = model.transcribe(str(video_path), language=language)
+                
+                # whisper.cpp timestamps are in centiseconds
+                write_segments_vtt(
+                    ({"start": seg.t0 / 100, "end": seg.t1 / 100, "text": seg.text} for seg in segments),
+                    output_path
+                )
+                
+                log_success(f"Transcribed: {output_path.name}")
+                return True
+            except Exception as e:
+                log_error(f"whisper.cpp failed: {e}")
+                return False
+    
+    if HAS_WHISPER:
+        try:
+            import whisper
+        except ImportError as e:
+            log_warning(f"whisper failed to import ({e})")
+        else:
+            log_info("Using openai-whisper")
+            try:
+                language = CFG.transcription.language
+                log_info(f"Language: {language}")
+                model = whisper.load_model("base")
+                result = model.transcribe(str(video_path), language=language)
+                
+                write_segments_vtt(result.get("segments", []), output_path)
+                
+                log_success(f"Transcribed: {output_path.name}")
+                return True
+            except Exception as e:
+                log_error(f"whisper failed: {e}")
+                return False
+    
+    log_error("No whisper implementation available")
+    return False
+
+
+SILENT_VTT = b"WEBVTT\n\nNOTE This video has no audio track (silent film).\n\n"
+
+
+def obtain_subtitles(video_path: Path, subtitles_path: Path, metadata: dict) -> bool:
+    """Write baseline subtitles: embedded track if present, else Whisper."""
+    # Handle silent movies (no audio stream)
+    if not metadata.get("has_audio"):
+        log_info("🎬 Silent movie detected - no audio to transcribe")
+        with open(subtitles_path, "wb") as f:
+            f.write(SILENT_VTT)
+        return True
+    
+    if metadata.get("has_subtitles"):
+        if extract_subtitles(video_path, subtitles_path, metadata.get("subtitle_codec")):
             return True
-        except Exception as e:
-            log_error(f"whisper failed: {e}")
-            return False
     
-    else:
-        log_error("No whisper implementation available")
-        return False
+    return transcribe_with_whisper(video_path, subtitles_path)
 
 
 # =============================================================================
 # CONVERT MODE - DOWNSAMPLING
 # =============================================================================
 
-def downsample_video(video_path: Path, output_path: Path) -> Optional[Path]:
-    """Downsample video to fit under MAX_SIZE_MB."""
-    size_mb = get_file_size_mb(video_path)
-    
-    if size_mb <= MAX_SIZE_MB:
-        log_video(f"Video is {size_mb:.1f}MB - no downsampling needed")
-        return video_path
-    
-    log_video(f"Video is {size_mb:.1f}MB - downsampling to fit under {MAX_SIZE_MB}MB")
-    
+AUDIO_BITRATE = 128_000       # bits/s for the downsampled AAC track
+MIN_BITS_PER_PIXEL = 0.02     # below this a target looks too blocky to use
+
+
+def pick_downsample_target(video_bitrate: int) -> dict:
+    """Pick the highest-quality target the video bitrate can sustain."""
     for target in DOWNSAMPLE_TARGETS:
-        log_info(f"Trying {target['label']}...")
-        
         width, height = target["resolution"].split("x")
+        pixel_rate = int(width) * int(height) * target["fps"]
+        if video_bitrate >= pixel_rate * MIN_BITS_PER_PIXEL:
+            return target
+    return DOWNSAMPLE_TARGETS[-1]
+
+
+@functools.lru_cache(maxsize=1)
+def detect_h264_encoders() -> frozenset:
+    """Return the hardware H.264 encoders compiled into ffmpeg (probed once)."""
+    code, stdout, stderr = run_command(["ffmpeg", "-hide_banner", "-encoders"])
+    if code != 0:
+        return frozenset()
+    candidates = ("h264_videotoolbox", "h264_nvenc", "h264_qsv", "h264_vaapi")
+    return frozenset(name for name in candidates if name in stdout)
+
+
+@functools.lru_cache(maxsize=1)
+def detect_hw_scalers() -> frozenset:
+    """Return the hardware scale filters compiled into ffmpeg (probed once)."""
+    code, stdout, stderr = run_command(["ffmpeg", "-hide_banner", "-filters"])
+    if code != 0:
+        return frozenset()
+    return frozenset(name for name in ("scale_vt", "scale_cuda") if f" {name} " in stdout)
+
+
+# Hardware decode -> scale -> encode pipelines that keep frames on the device
+HW_PIPELINES = {
+    "h264_videotoolbox": {
+        "scaler": "scale_vt",
+        "input_args": ["-hwaccel", "videotoolbox", "-hwaccel_output_format", "videotoolbox_vld"],
+    },
+    "h264_nvenc": {
+        "scaler": "scale_cuda",
+        "input_args": ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"],
+    },
+}
+
+
+def select_video_encoders() -> list:
+    """Return H.264 encoders to try in order: hardware first, libx264 last."""
+    encoders = detect_h264_encoders()
+    selected = []
+    if IS_APPLE_SILICON and "h264_videotoolbox" in encoders:
+        selected.append("h264_videotoolbox")
+    elif "h264_nvenc" in encoders:
+        selected.append("h264_nvenc")
+    selected.append("libx264")
+    return selected
+
+
+def select_encode_pipelines(hw_scaling: bool = True) -> list:
+    """
+    Return (encoder, hw_scaling) pairs to try in order. Hardware encoders
+    are tried with on-device scaling first, then with software scaling.
+    """
+    scalers = detect_hw_scalers() if hw_scaling else frozenset()
+    pipelines = []
+    for encoder in select_video_encoders():
+        pipeline = HW_PIPELINES.get(encoder)
+        if pipeline and pipeline["scaler"] in scalers:
+            pipelines.append((encoder, True))
+        pipelines.append((encoder, False))
+    return pipelines
+
+
+def fit_resolution(src_width: int, src_height: int, max_width: int, max_height: int) -> Tuple[int, int]:
+    """Fit a resolution inside a box, keeping aspect ratio, never upscaling, even dims."""
+    scale = min(max_width / src_width, max_height / src_height, 1.0)
+    width = max(2, int(src_width * scale) // 2 * 2)
+    height = max(2, int(src_height * scale) // 2 * 2)
+    return width, height
+
+
+def video_encoder_args(encoder: str, bitrate: int) -> list:
+    """Build ffmpeg video codec args targeting an average bitrate."""
+    rate_args = [
+        "-b:v", str(bitrate),
+        "-maxrate", str(int(bitrate * 1.1)),
+        "-bufsize", str(bitrate * 2),
+    ]
+    if encoder == "h264_videotoolbox":
+        return ["-c:v", encoder, *rate_args]
+    if encoder == "h264_nvenc":
+        return ["-c:v", encoder, "-preset", "p4", "-rc", "vbr", *rate_args]
+    return ["-c:v", "libx264", "-preset", "fast", *rate_args]
+
+
+def encode_downsample(video_path: Path, output_path: Path, metadata: dict, video_bitrate: int) -> Optional[dict]:
+    """
+    Encode video_path at video_bitrate with the downsample target that
+    bitrate affords. Returns the target used, or None if every encoder failed.
+    """
+    target = pick_downsample_target(video_bitrate)
+    log_info(f"Encoding {target['label']} at {video_bitrate // 1000}kbps...")
+    
+    max_width, max_height = (int(v) for v in target["resolution"].split("x"))
+    known_size = metadata.get("width") and metadata.get("height")
+    if known_size:
+        # Hardware scalers can't preserve aspect ratio themselves
+        width, height = fit_resolution(metadata["width"], metadata["height"], max_width, max_height)
+        scale_args = f"{width}:{height}"
+    else:
+        scale_args = f"{max_width}:{max_height}:force_original_aspect_ratio=decrease"
+    
+    # Hardware encoders may be compiled in without a usable device (or the
+    # source codec may not decode in hardware), so fall back step by step
+    for encoder, hw_scaling in select_encode_pipelines(hw_scaling=bool(known_size)):
+        if hw_scaling:
+            pipeline = HW_PIPELINES[encoder]
+            input_args = pipeline["input_args"]
+            video_filter = f"fps={target['fps']},{pipeline['scaler']}={scale_args}"
+            log_info(f"Using encoder: {encoder} ({pipeline['scaler']})")
+        else:
+            input_args = []
+            video_filter = f"fps={target['fps']},scale={scale_args}"
+            log_info(f"Using encoder: {encoder}")
         
         cmd = [
-            "ffmpeg", "-y", "-i", str(video_path),
-            "-vf", f"fps={target['fps']},scale={width}:{height}:force_original_aspect_ratio=decrease",
-            "-c:v", "libx264", "-crf", "28", "-preset", "fast",
-            "-c:a", "aac", "-b:a", "128k",
+            "ffmpeg", *FFMPEG_LOG_ARGS, "-y", *input_args, "-i", str(video_path),
+            "-vf", video_filter,
+            *video_encoder_args(encoder, video_bitrate),
+            "-c:a", "aac", "-b:a", str(AUDIO_BITRATE),
             str(output_path)
         ]
         
         code, stdout, stderr = run_command(cmd)
-        
         if code == 0 and output_path.exists():
-            new_size = get_file_size_mb(output_path)
-            if new_size <= MAX_SIZE_MB:
-                log_success(f"Downsampled to {new_size:.1f}MB ({target['label']})")
-                return output_path
-            else:
-                log_warning(f"Still {new_size:.1f}MB - trying lower quality")
-        else:
-            log_warning(f"FFmpeg failed for {target['label']}")
+            return target
+        log_warning(f"FFmpeg failed with {encoder}")
     
-    log_error("Could not downsample video under size limit")
+    log_error(f"FFmpeg failed for {target['label']}")
     return None
 
 
-# =============================================================================
-# CONVERT MODE - GEMINI
-# =============================================================================
-
-def call_gemini(
-    api_key: str,
-    prompt_path: Path,
-    subtitles_path: Path,
-    video_path: Path
-) -> Optional[dict]:
+def downsample_video(video_path: Path, output_path: Path, metadata: dict) -> Optional[Path]:
     """
-    Call Gemini API to enhance subtitles.
-    Returns dict with 'raw' (full response) and 'vtt' (extracted VTT) keys.
+    Downsample video to fit under MAX_SIZE_MB.
+    The video bitrate is derived from the size budget and duration, so one
+    encode usually lands under the limit. Encoders can overshoot their
+    average bitrate, so an oversized result gets one re-encode at a bitrate
+    scaled down by how far it missed.
     """
-    if not HAS_GENAI:
-        log_error("google-genai not installed (pip install google-genai)")
+    size_mb = get_file_size_mb(video_path)
+    
+    if size_mb <= MAX_SIZE_MB:
+        log_video(f"Video is {size_mb:.1f}MB - no downsampling needed")
+        return video_path
+    
+    log_video(f"Video is {size_mb:.1f}MB - downsampling to fit under {MAX_SIZE_MB}MB")
+    
+    duration = metadata.get("duration", 0)
+    if duration <= 0:
+        log_error("Unknown video duration - cannot compute target bitrate")
         return None
     
-    log_ai(f"Calling Gemini ({GEMINI_MODEL})...")
+    # Bit budget with 5% headroom for container overhead
+    budget_bits = MAX_SIZE_MB * 0.95 * 8 * 1024 * 1024
+    video_bitrate = int((budget_bits - AUDIO_BITRATE * duration) / duration)
+    if video_bitrate <= 0:
+        log_error(f"Video is too long to fit under {MAX_SIZE_MB}MB")
+        return None
     
-    # Read prompt
-    with open(prompt_path, "r") as f:
-        prompt_text = f.read()
-
-    # Inject config settings
-    thinking_level = CONFIG["gemini"].get("thinking", "HIGH").upper()
-    prompt_text = prompt_text.replace("{{THINKING_LEVEL}}", thinking_level)
+    target = encode_downsample(video_path, output_path, metadata, video_bitrate)
+    if target is None:
+        return None
     
-    # Read subtitles
-    with open(subtitles_path, "r") as f:
-        subtitles_text = f.read()
+    new_size = get_file_size_mb(output_path)
+    if new_size > MAX_SIZE_MB:
+        video_bitrate = int(video_bitrate * MAX_SIZE_MB * 0.95 / new_size)
+        log_warning(f"Downsampled video is {new_size:.1f}MB - retrying at a lower bitrate")
+        target = encode_downsample(video_path, output_path, metadata, video_bitrate)
+        if target is None:
+            return None
+        new_size = get_file_size_mb(output_path)
+        if new_size > MAX_SIZE_MB:
+            log_error(f"Downsampled video is still {new_size:.1f}MB")
+            return None
     
-    # Estimate cost (rough estimate based on file sizes)
-    video_size_mb = get_file_size_mb(video_path)
-    prompt_tokens = len(prompt_text) // 4
-    subtitle_tokens = len(subtitles_text) // 4
-    video_tokens = int(video_size_mb * 1000)  # ~1000 tokens per MB
-    total_input = prompt_tokens + subtitle_tokens + video_tokens
+    log_success(f"Downsampled to {new_size:.1f}MB ({target['label']})")
+    return output_path
+
+
+# =============================================================================
+# CONVERT MODE - GEMINI
+# =============================================================================
+
+def wait_for_processing(video_file, refresh):
+    """Poll an uploaded file until Gemini finishes processing it, with backoff."""
+    delay = 0.5
+    if video_file.state.name == "PROCESSING":
+        log_info("Waiting for video processing...")
+    while video_file.state.name == "PROCESSING":
+        time.sleep(delay)
+        delay = min(delay * 1.5, 5.0)
+        video_file = refresh(video_file.name)
+    return video_file
+
+
+def retry_on_404(func, attempts: int = 3):
+    """Call func, retrying with backoff while a fresh upload propagates (404)."""
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if "404" in str(e) and attempt < attempts - 1:
+                log_info(f"File not available yet, retrying in {2 ** attempt}s...")
+                time.sleep(2 ** attempt)
+                continue
+            raise
+
+
+def start_stream(func):
+    """
+    Start a streamed generation and pull its first chunk, so errors raised on
+    the first request (e.g. 404) surface here, inside retry_on_404.
+    Returns an iterator over all chunks.
+    """
+    stream = iter(func())
+    first = next(stream, None)
+    return itertools.chain([first] if first is not None else [], stream)
+
+
+def stop_reason(chunk) -> Optional[str]:
+    """Why a response was blocked or stopped, if the chunk says (both SDKs)."""
+    block = getattr(getattr(chunk, "prompt_feedback", None), "block_reason", None)
+    if block:
+        return f"prompt blocked: {getattr(block, 'name', block)}"
+    candidates = getattr(chunk, "candidates", None) or []
+    finish = getattr(candidates[0], "finish_reason", None) if candidates else None
+    if finish:
+        return f"finish reason: {getattr(finish, 'name', finish)}"
+    return None
+
+
+def write_stream(chunks, out) -> Tuple[int, object, Optional[str]]:
+    """
+    Write the text of streamed response chunks to a binary file as they
+    arrive. Returns (bytes written, last usage metadata seen, last stop
+    reason seen); usage and the stop reason come with the final chunk.
+    """
+    written = 0
+    usage = reason = None
+    for chunk in chunks:
+        try:
+            text = chunk.text
+        except ValueError:
+            text = None  # Legacy SDK: a chunk without parts, e.g. final SAFETY/MAX_TOKENS
+        if text:
+            written += out.write(text.encode("utf-8"))
+        usage = getattr(chunk, 'usage_metadata', None) or usage
+        reason = stop_reason(chunk) or reason
+    return written, usage, reason
+
+
+def get_context_cache(client, prompt_text: str, video_file, video_path: Path, tools: list) -> Optional[str]:
+    """
+    Get an explicit context cache holding the static prompt and the video.
+    Reuses a live cache from a previous run when the prompt, video and tools
+    are unchanged. Returns the cache name, or None if caching is unavailable.
+    """
+    key_source = "\n".join([
+        GEMINI_MODEL,
+        json.dumps(vars(CFG.gemini.grounding), sort_keys=True),
+        file_sha256(video_path),
+        prompt_text,
+    ])
+    key = hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+    genai, types = import_genai()
+    
+    registry = load_json_cache(CONTEXT_CACHE_FILE)
+    entry = registry.get(key)
+    if entry and entry.get("expiry", 0) > time.time():
+        try:
+            cache = client.caches.get(name=entry["name"])
+            log_info(f"Reusing context cache: {cache.name}")
+            return cache.name
+        except Exception:
+            pass  # Expired or deleted server-side, create a new one
     
-    log_cost(f"Estimated input: ~{total_input:,} tokens")
+    log_ai("Creating context cache for prompt + video...")
+    try:
+        cache = retry_on_404(lambda: client.caches.create(
+            model=GEMINI_MODEL,
+            config=types.CreateCachedContentConfig(
+                # Static prompt first so implicit prefix caching also applies
+                contents=[
+                    prompt_text,
+                    types.Part.from_uri(file_uri=video_file.uri, mime_type=video_file.mime_type)
+                ],
+                tools=tools if tools else None,
+                ttl=f"{CONTEXT_CACHE_TTL}s"
+            )
+        ))
+    except Exception as e:
+        log_warning(f"Context caching unavailable, sending full request: {e}")
+        return None
     
-    import time
+    # Expire locally a little early so we never hand out a dying cache
+    registry = {k: v for k, v in registry.items() if v.get("expiry", 0) > time.time()}
+    registry[key] = {"name": cache.name, "expiry": time.time() + CONTEXT_CACHE_TTL - 60}
+    save_json_cache(CONTEXT_CACHE_FILE, registry)
     
-    # Build combined prompt
-    full_prompt = f"""{prompt_text}
+    log_success(f"Context cache created: {cache.name}")
+    return cache.name
 
+
+BASELINE_VTT_HEADER = """
 ---
 
 ## Baseline VTT Input
 
 ```vtt
-{subtitles_text}
+"""
+
+VIDEO_FILE_FOOTER = """
 ```
 
 ---
@@ -615,57 +1454,181 @@ def call_gemini(
 
 The video file is attached. Please analyze it and generate the enhanced VTT.
 """
+
+
+@functools.lru_cache(maxsize=4)
+def _load_prompt(path_str: str, mtime_ns: int) -> str:
+    """Read the prompt template and inject config settings (memoized per path and mtime)."""
+    thinking_level = CFG.gemini.thinking.upper()
+    return Path(path_str).read_text(encoding="utf-8").replace("{{THINKING_LEVEL}}", thinking_level)
+
+
+def gemini_tools(types) -> list:
+    """Grounding tools from config, as SDK types (new SDK) or dicts (legacy, types is None)."""
+    tools = []
+    if CFG.gemini.grounding.enabled:
+        if CFG.gemini.grounding.source == "google_search":
+            if types is None:
+                tools.append({"google_search": {}})
+            else:
+                tools.append(types.Tool(google_search=types.GoogleSearch()))
+    return tools
+
+
+def upload_video(api_key: str, video_path: Path):
+    """
+    Upload a video to Gemini and wait until it has been processed.
+    Returns the uploaded file handle, or None on failure.
+    """
+    if not HAS_GENAI:
+        log_error("google-genai not installed (pip install google-genai)")
+        return None
     
     try:
-        if GENAI_NEW:
-            # New google.genai SDK
-            client = genai.Client(api_key=api_key)
-            
-            # Upload video file
+        genai, types = import_genai()
+        if types is not None:
+            client = get_genai_client(api_key)
+            get_file = lambda name: client.files.get(name=name)
+            upload_file = lambda path: client.files.upload(file=path)
+        else:
+            genai.configure(api_key=api_key)
+            get_file = genai.get_file
+            upload_file = lambda path: genai.upload_file(str(path))
+        
+        # Reuse a previous upload of the same bytes while Gemini still has it
+        sha = file_sha256(video_path)
+        uploads = load_json_cache(UPLOAD_CACHE_FILE)
+        entry = uploads.get(sha)
+        video_file = None
+        if entry and entry.get("expiry", 0) > time.time():
+            try:
+                video_file = get_file(entry["name"])
+                log_info(f"Reusing uploaded video: {video_file.name}")
+            except Exception:
+                video_file = None  # Deleted server-side, upload again
+        
+        if video_file is None:
             log_ai("Uploading video to Gemini...")
-            video_file = client.files.upload(file=video_path)
-            
-            # Wait for processing
-            while video_file.state.name == "PROCESSING":
-                log_info("Waiting for video processing...")
-                time.sleep(5)
-                video_file = client.files.get(name=video_file.name)
+            video_file = upload_file(video_path)
+        
+        video_file = wait_for_processing(video_file, get_file)
+    except Exception as e:
+        log_error(f"Gemini upload error: {e}")
+        return None
+    
+    if video_file.state.name == "FAILED":
+        log_error("Video processing failed")
+        return None
+    
+    if not entry or entry.get("name") != video_file.name:
+        uploads = {k: v for k, v in uploads.items() if v.get("expiry", 0) > time.time()}
+        uploads[sha] = {"name": video_file.name, "expiry": time.time() + UPLOAD_CACHE_TTL}
+        save_json_cache(UPLOAD_CACHE_FILE, uploads)
+    
+    log_success("Video uploaded and processed")
+    return video_file
+
+
+def prepare_gemini_video(api_key: str, video_path: Path, prompt_text: str):
+    """
+    Upload a video and, with the new SDK, create its context cache.
+    Runs in the background while subtitles are still being prepared; call_gemini
+    then picks the cache up from the registry instead of creating it.
+    Returns the uploaded file handle, or None on failure.
+    """
+    video_file = upload_video(api_key, video_path)
+    if video_file is None:
+        return None
+    _, types = import_genai()
+    if types is not None:
+        get_context_cache(get_genai_client(api_key), prompt_text, video_file, video_path, gemini_tools(types))
+    return video_file
+
+
+def call_gemini(
+    api_key: str,
+    prompt_text: str,
+    subtitles_path: Path,
+    video_path: Path,
+    out,
+    video_file=None
+) -> bool:
+    """
+    Call Gemini API to enhance subtitles, streaming the full response text
+    into the binary file out as it arrives.
+    Uploads video_path unless an already uploaded video_file is given.
+    Returns True on success.
+    """
+    if not HAS_GENAI:
+        log_error("google-genai not installed (pip install google-genai)")
+        return False
+    
+    log_ai(f"Calling Gemini ({GEMINI_MODEL})...")
+    
+    # Read subtitles as bytes: the size feeds the estimate directly
+    subtitles_bytes = subtitles_path.read_bytes()
+    subtitles_text = subtitles_bytes.decode("utf-8")
+    
+    # Estimate cost (rough estimate based on file sizes, ~4 bytes per token)
+    video_size_mb = get_file_size_mb(video_path)
+    prompt_tokens = len(prompt_text.encode("utf-8")) // 4
+    subtitle_tokens = len(subtitles_bytes) // 4
+    video_tokens = int(video_size_mb * 1000)  # ~1000 tokens per MB
+    total_input = prompt_tokens + subtitle_tokens + video_tokens
+    
+    log_cost(f"Estimated input: ~{total_input:,} tokens")
+    
+    # Per-video request as separate parts: the static prompt is sent (and
+    # cached) on its own, and the subtitles are never copied into one string
+    request_parts = [BASELINE_VTT_HEADER, subtitles_text, VIDEO_FILE_FOOTER]
+    
+    if video_file is None:
+        video_file = upload_video(api_key, video_path)
+        if video_file is None:
+            return False
+    
+    try:
+        genai, types = import_genai()
+        if types is not None:
+            # New google.genai SDK
+            client = get_genai_client(api_key)
             
-            if video_file.state.name == "FAILED":
-                log_error("Video processing failed")
-                return None
+            tools = gemini_tools(types)
             
-            log_success("Video uploaded and processed")
+            # Cache prompt + video; only the baseline VTT is sent fresh
+            cache_name = get_context_cache(client, prompt_text, video_file, video_path, tools)
             
-            # Wait for file propagation to avoid 404
-            log_info("Waiting 5s for file propagation...")
-            time.sleep(5)
+            # Prepare config (tools live in the cache when one is used)
+            text_parts = [types.Part.from_text(text=part) for part in request_parts]
+            if cache_name:
+                contents = text_parts
+                gen_config = types.GenerateContentConfig(
+                    cached_content=cache_name,
+                    temperature=CFG.gemini.temperature,
+                    max_output_tokens=CFG.gemini.max_output_tokens
+                )
+            else:
+                contents = [
+                    types.Part.from_text(text=prompt_text),
+                    types.Part.from_uri(file_uri=video_file.uri, mime_type=video_file.mime_type),
+                    *text_parts
+                ]
+                gen_config = types.GenerateContentConfig(
+                    temperature=CFG.gemini.temperature,
+                    max_output_tokens=CFG.gemini.max_output_tokens,
+                    tools=tools if tools else None
+                )
             
             # Generate content
             log_ai("Generating enhanced VTT...")
-            
-            # Prepare tools (Grounding)
-            tools = []
-            if CONFIG["gemini"]["grounding"]["enabled"]:
-                if CONFIG["gemini"]["grounding"]["source"] == "google_search":
-                    tools.append(types.Tool(google_search=types.GoogleSearch()))
-            
-            # Prepare config
-            gen_config = types.GenerateContentConfig(
-                temperature=CONFIG["gemini"]["temperature"],
-                max_output_tokens=CONFIG["gemini"]["max_output_tokens"],
-                tools=tools if tools else None
-            )
 
             try:
-                response = client.models.generate_content(
+                # Freshly uploaded files can 404 briefly while propagating
+                chunks = retry_on_404(lambda: start_stream(lambda: client.models.generate_content_stream(
                     model=GEMINI_MODEL,
-                    contents=[
-                        types.Part.from_uri(file_uri=video_file.uri, mime_type=video_file.mime_type),
-                        full_prompt
-                    ],
+                    contents=contents,
                     config=gen_config
-                )
+                )))
             except Exception as e:
                 # Catch 404 specifically
                 if "404" in str(e):
@@ -675,128 +1638,182 @@ The video file is attached. Please analyze it and generate the enhanced VTT.
                     log_error("This implies the model name is invalid or the file is not yet available.")
                 raise e
             
-            # Extract text
-            text = response.text
+            written, usage, reason = write_stream(chunks, out)
             
             # Log usage if available
-            if hasattr(response, 'usage_metadata') and response.usage_metadata:
-                usage = response.usage_metadata
-                cost = estimate_cost(GEMINI_MODEL, usage.prompt_token_count, usage.candidates_token_count)
-                log_cost(f"Actual usage: {usage.prompt_token_count:,} input, {usage.candidates_token_count:,} output tokens (${cost:.4f})")
+            if usage:
+                cached = usage.cached_content_token_count or 0
+                cost = estimate_cost(GEMINI_MODEL, usage.prompt_token_count, usage.candidates_token_count, cached)
+                log_cost(f"Actual usage: {usage.prompt_token_count:,} input ({cached:,} cached), {usage.candidates_token_count:,} output tokens (${cost:.4f})")
         
         else:
             # Legacy google.generativeai SDK
             genai.configure(api_key=api_key)
             
-            # Upload video file
-            log_ai("Uploading video to Gemini...")
-            video_file = genai.upload_file(str(video_path))
-            
-            # Wait for processing
-            while video_file.state.name == "PROCESSING":
-                log_info("Waiting for video processing...")
-                time.sleep(5)
-                video_file = genai.get_file(video_file.name)
-            
-            if video_file.state.name == "FAILED":
-                log_error("Video processing failed")
-                return None
-            
-            log_success("Video uploaded and processed")
-            
-            # Wait for propagation
-            log_info("Waiting 5s for file propagation...")
-            time.sleep(5)
-            
-            # Prepare tools (Grounding)
-            tools = []
-            if CONFIG["gemini"]["grounding"]["enabled"]:
-                if CONFIG["gemini"]["grounding"]["source"] == "google_search":
-                    tools.append({"google_search": {}})
+            tools = gemini_tools(types)
 
             # Create model with settings
             model = genai.GenerativeModel(
                 model_name=GEMINI_MODEL,
                 generation_config={
-                    "temperature": CONFIG["gemini"]["temperature"],
-                    "max_output_tokens": CONFIG["gemini"]["max_output_tokens"],
+                    "temperature": CFG.gemini.temperature,
+                    "max_output_tokens": CFG.gemini.max_output_tokens,
                 },
                 tools=tools if tools else None
             )
             
             # Generate content
             log_ai("Generating enhanced VTT...")
-            response = model.generate_content(
-                [video_file, full_prompt],
+            response = retry_on_404(lambda: model.generate_content(
+                [video_file, prompt_text, *request_parts],
+                stream=True,
                 request_options={"timeout": 600}
-            )
+            ))
             
-            # Extract text
-            text = response.text
+            written, usage, reason = write_stream(response, out)
             
             # Log usage if available
-            if hasattr(response, 'usage_metadata') and response.usage_metadata:
-                usage = response.usage_metadata
+            if usage:
                 cost = estimate_cost(GEMINI_MODEL, usage.prompt_token_count, usage.candidates_token_count)
                 log_cost(f"Actual usage: {usage.prompt_token_count:,} input, {usage.candidates_token_count:,} output tokens (${cost:.4f})")
         
-        # Keep full response for logging
-        raw_text = text
-        
-        # Extract just the VTT portion
-        vtt_text = None
-        if "WEBVTT" in text:
-            vtt_start = text.find("WEBVTT")
-            # Find end of VTT (usually marked by ```)
-            vtt_end = text.find("```", vtt_start)
-            if vtt_end > vtt_start:
-                vtt_text = text[vtt_start:vtt_end].strip()
-            else:
-                vtt_text = text[vtt_start:].strip()
-        else:
-            # No VTT found, use full text
-            vtt_text = text
+        # Empty or blocked responses are failures, not empty outputs
+        if not written:
+            log_error(f"Gemini returned no text ({reason or 'no reason given'})")
+            return False
         
-        return {
-            'raw': raw_text,
-            'vtt': vtt_text
-        }
+        return True
         
     except Exception as e:
         log_error(f"Gemini API error: {e}")
-        return None
+        return False
 
 
 # =============================================================================
 # CONVERT MODE - MAIN
 # =============================================================================
 
-def get_output_path(base_name: str, extension: str, directory: Path, specified: Optional[str] = None) -> Path:
-    """Get output path, avoiding overwrites, defaulting to input directory."""
+MAX_NAME_PROBES = 100  # names to try before a random suffix
+# os.link errors meaning the filesystem can't hard-link (FAT32/exFAT, SMB, some FUSE)
+NO_LINK_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV}
+
+
+def link_new(src: str, path: Path, dir_fd: Optional[int] = None) -> bool:
+    """
+    Hard-link src to path unless path already exists. Returns False if it does.
+    With dir_fd (open_dir of path.parent), src and path resolve relative to it.
+    """
+    dst = path.name if dir_fd is not None else str(path)
+    try:
+        os.link(src, dst, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        return True
+    except FileExistsError:
+        return False
+    except OSError as e:
+        if e.errno not in NO_LINK_ERRNOS:
+            raise
+    return copy_new(src, dst, dir_fd)
+
+
+def copy_new(src: str, dst: str, dir_fd: Optional[int] = None) -> bool:
+    """
+    Fallback for link_new where hard links are unsupported: create dst
+    exclusively and copy src into it. Returns False if dst already exists.
+    """
+    try:
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644, dir_fd=dir_fd)
+    except FileExistsError:
+        return False
+    try:
+        with open(src, "rb", opener=lambda p, flags: os.open(p, flags, dir_fd=dir_fd)) as f_in, \
+                os.fdopen(out_fd, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+    except BaseException:
+        os.unlink(dst, dir_fd=dir_fd)
+        raise
+    return True
+
+
+def used_output_counters(base_name: str, extension: str, directory: Path) -> set:
+    """Numbered suffixes taken by base_name outputs in directory (0 = unsuffixed), from one scan."""
+    pattern = re.compile(rf"{re.escape(base_name)}(?:-([1-9]\d*))?\.{re.escape(extension)}")
+    used = set()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                match = pattern.fullmatch(entry.name)
+                if match:
+                    used.add(int(match.group(1) or 0))
+    except FileNotFoundError:
+        pass
+    return used
+
+
+def publish_output(tmp: str, base_name: str, extension: str, directory: Path, dir_fd: Optional[int] = None) -> Path:
+    """
+    Publish a complete temp file under the first free {base_name}[-N].{extension}
+    in directory, then drop the temp name. Linking fails instead of
+    overwriting, so concurrent conversions can't clobber each other, and the
+    output never exists as an empty or partial file (except briefly on
+    filesystems without hard links, where it is copied into place).
+    tmp is relative to dir_fd (open_dir of directory) when given, else a path.
+    """
+    used = used_output_counters(base_name, extension, directory)
+    counter = 0
+    for _ in range(MAX_NAME_PROBES):
+        while counter in used:
+            counter += 1
+        suffix = f"-{counter}" if counter else ""
+        path = directory / f"{base_name}{suffix}.{extension}"
+        if link_new(tmp, path, dir_fd):
+            break
+        used.add(counter)  # Created since the scan
+    else:
+        # Crowded directory: a random suffix avoids probing any further
+        path = directory / f"{base_name}-{uuid.uuid4().hex[:8]}.{extension}"
+        if not link_new(tmp, path, dir_fd):
+            raise FileExistsError(f"Output name taken: {path}")
+    
+    os.unlink(tmp, dir_fd=dir_fd)
+    return path
+
+
+def save_output(
+    data,
+    base_name: str,
+    extension: str,
+    directory: Path,
+    specified: Optional[str] = None,
+    dir_fd: Optional[int] = None
+) -> Path:
+    """
+    Write an output file without overwriting existing ones, defaulting to
+    the input directory. An explicitly specified path is replaced atomically.
+    dir_fd, if given, is open_dir(directory). Returns the path written.
+    """
     if specified:
-        return Path(specified)
-    
-    output = directory / f"{base_name}.{extension}"
-    counter = 1
-    while output.exists():
-        output = directory / f"{base_name}-{counter}.{extension}"
-        counter += 1
+        path = Path(specified)
+        atomic_write_bytes(path, data)
+        return path
     
-    return output
+    tmp = write_temp_file(directory, base_name, data, dir_fd)
+    try:
+        return publish_output(tmp, base_name, extension, directory, dir_fd)
+    except BaseException:
+        os.unlink(tmp, dir_fd=dir_fd)
+        raise
 
 
-def cmd_convert(video_file: str, output_vtt: Optional[str] = None):
+def cmd_convert(video_file: str, output_vtt: Optional[str] = None, parallel: bool = True):
     """Convert video to enhanced VTT."""
-    video_path = Path(video_file)
-    
-    if not video_path.exists():
-        # Try checking in MEDIA_DIR
-        candidate = MEDIA_DIR / video_file
-        if candidate.exists():
-            video_path = candidate
-        else:
-            log_error(f"Video file not found: {video_file} (searched in . and {MEDIA_DIR})")
-            sys.exit(1)
+    # Look in . first, then MEDIA_DIR
+    resolved = resolve_first_existing([Path(video_file), MEDIA_DIR / video_file])
+    if not resolved:
+        log_error(f"Video file not found: {video_file} (searched in . and {MEDIA_DIR})")
+        sys.exit(1)
+    video_path, video_stat = resolved
     
     # Generate session UUID
     session_id = str(uuid.uuid4())[:8]
@@ -815,76 +1832,118 @@ def cmd_convert(video_file: str, output_vtt: Optional[str] = None):
         log_info("Set environment variable or add to secrets.json")
         sys.exit(1)
     
-    # Check prompt file
-    prompt_path = Path(PROMPT_FILE)
-    if not prompt_path.exists():
-        # Try resolving relative to BASE_DIR
-        candidate = BASE_DIR / PROMPT_FILE
-        if candidate.exists():
-            prompt_path = candidate
-        else:
-            log_error(f"Prompt file not found: {PROMPT_FILE}")
-            sys.exit(1)
+    # Check prompt file (as given, then relative to BASE_DIR)
+    resolved = resolve_first_existing([Path(PROMPT_FILE), BASE_DIR / PROMPT_FILE])
+    if not resolved:
+        log_error(f"Prompt file not found: {PROMPT_FILE}")
+        sys.exit(1)
+    prompt_path, prompt_stat = resolved
+    prompt_text = _load_prompt(str(prompt_path), prompt_stat.st_mtime_ns)
     
     # Step 1: Check video health
     print("\n" + "-" * 40)
-    metadata = ffprobe_check(video_path)
+    metadata = ffprobe_check(video_path, video_stat)
     if not metadata:
         log_error("Video check failed")
         sys.exit(1)
     
-    # Step 2: Extract or generate subtitles
+    # Step 2: Prepare subtitles and video (independent, so run in parallel)
     print("\n" + "-" * 40)
     subtitles_path = work_dir / f"{base_name}-subtitles-{session_id}.vtt"
-    
-    # Handle silent movies (no audio stream)
-    if not metadata.get("has_audio"):
-        log_info("🎬 Silent movie detected - no audio to transcribe")
-        with open(subtitles_path, "w") as f:
-            f.write("WEBVTT\n\nNOTE This video has no audio track (silent film).\n\n")
-        success = True
-    elif metadata.get("has_subtitles"):
-        success = extract_subtitles(video_path, subtitles_path)
-        if not success:
-            success = transcribe_with_whisper(video_path, subtitles_path)
+    downsampled_path = work_dir / f"{base_name}-downsampled-{session_id}.mp4"
+    upload_future = None
+    
+    # Decide from the probed size so a compliant source never reaches ffmpeg
+    final_video = None
+    if metadata["size_mb"] <= MAX_SIZE_MB:
+        log_info(f"Source within limits ({metadata['size_mb']:.1f}MB), skipping downsample")
+        final_video = video_path
+    
+    if parallel:
+        log_info("Preparing subtitles and video in parallel")
+        if final_video:
+            # Nothing to encode, so the upload can start right away
+            upload_future = run_in_background(prepare_gemini_video, api_key, final_video, prompt_text)
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            subtitles_future = pool.submit(timed, obtain_subtitles, video_path, subtitles_path, metadata)
+            futures = [subtitles_future]
+            if not final_video:
+                futures.append(pool.submit(timed, downsample_video, video_path, downsampled_path, metadata))
+            
+            for future in concurrent.futures.as_completed(futures):
+                result, elapsed = future.result()
+                if future is not subtitles_future:
+                    final_video = result
+                    log_info(f"Video ready in {elapsed:.1f}s")
+                    # Upload and cache while subtitles may still be running
+                    if final_video:
+                        upload_future = run_in_background(prepare_gemini_video, api_key, final_video, prompt_text)
+                else:
+                    success = result
+                    log_info(f"Subtitles ready in {elapsed:.1f}s")
     else:
-        success = transcribe_with_whisper(video_path, subtitles_path)
+        if not final_video:
+            final_video, elapsed = timed(downsample_video, video_path, downsampled_path, metadata)
+            if not final_video:
+                # Fail before spending a full transcription on nothing
+                log_error("Failed to prepare video for upload")
+                sys.exit(1)
+            log_info(f"Video ready in {elapsed:.1f}s")
+        success, elapsed = timed(obtain_subtitles, video_path, subtitles_path, metadata)
+        log_info(f"Subtitles ready in {elapsed:.1f}s")
+    
+    if not final_video:
+        log_error("Failed to prepare video for upload")
+        sys.exit(1)
     
     if not success or not subtitles_path.exists():
         log_error("Failed to obtain subtitles")
         sys.exit(1)
     
-    # Step 3: Downsample if needed
+    # Step 3: Call Gemini
     print("\n" + "-" * 40)
-    downsampled_path = work_dir / f"{base_name}-downsampled-{session_id}.mp4"
-    final_video = downsample_video(video_path, downsampled_path)
-    
-    if not final_video:
-        log_error("Failed to prepare video for upload")
+    video_file = upload_future.result() if upload_future else upload_video(api_key, final_video)
+    if not video_file:
+        log_error("Failed to upload video")
         sys.exit(1)
     
-    # Step 4: Call Gemini
-    print("\n" + "-" * 40)
-    result = call_gemini(api_key, prompt_path, subtitles_path, final_video)
-    
-    if not result:
+    # Stream the response straight to disk rather than holding it in memory
+    response_path = work_dir / f"{base_name}-response-{session_id}.log"
+    with open(response_path, "wb") as response_file:
+        success = call_gemini(api_key, prompt_text, subtitles_path, final_video, response_file, video_file)
+        response_file.flush()
+        os.fsync(response_file.fileno())
+    
+    if not success:
+        # Keep whatever streamed before the failure; it has already been paid for
+        if response_path.stat().st_size:
+            log_path = publish_output(str(response_path), base_name, "log", work_dir)
+            log_warning(f"Partial response saved to: {log_path}")
+        else:
+            response_path.unlink()
         log_error("Failed to generate enhanced VTT")
         sys.exit(1)
     
-    # Step 5: Save outputs (both log and VTT)
+    # Step 4: Save outputs (both log and VTT)
     print("\n" + "-" * 40)
     
-    # Save full response as log (includes Pass 1 event log + Pass 2 VTT)
-    log_path = get_output_path(base_name, "log", work_dir, None)
-    with open(log_path, "w", encoding="utf-8") as f:
-        f.write(result['raw'])
-    log_success(f"Full response saved to: {log_path}")
-    
-    # Save extracted VTT
-    output_path = get_output_path(base_name, "vtt", work_dir, output_vtt)
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(result['vtt'])
-    log_success(f"Enhanced VTT saved to: {output_path}")
+    # Outputs land in work_dir: resolve names against one directory handle
+    work_dir_fd = open_dir(work_dir)
+    try:
+        # Save full response as log (includes Pass 1 event log + Pass 2 VTT)
+        response_tmp = response_path.name if work_dir_fd is not None else str(response_path)
+        log_path = publish_output(response_tmp, base_name, "log", work_dir, work_dir_fd)
+        log_success(f"Full response saved to: {log_path}")
+        
+        # Save extracted VTT, matched in place over a mapping of the log
+        # (call_gemini only succeeds with text, so the log is never empty)
+        with open(log_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+            output_path = save_output(extract_vtt(raw), base_name, "vtt", work_dir, output_vtt, work_dir_fd)
+        log_success(f"Enhanced VTT saved to: {output_path}")
+    finally:
+        if work_dir_fd is not None:
+            os.close(work_dir_fd)
     
     # Summary
     print("\n" + "=" * 40)
@@ -906,22 +1965,26 @@ def cmd_test():
     
     passed = 0
     failed = 0
+    lines = []  # Report is buffered and written once before the summary
+    
+    def section(title: str):
+        lines.append(f"\n📋 {title}:")
     
     def test(condition: bool, name: str, details: str = ""):
         nonlocal passed, failed
         if condition:
             passed += 1
-            print(f"  ✅ {name}")
+            lines.append(f"  ✅ {name}")
         else:
             failed += 1
-            print(f"  ❌ {name}")
+            lines.append(f"  ❌ {name}")
             if details:
-                print(f"     {details}")
+                lines.append(f"     {details}")
     
     # -------------------------------------------------------------------------
     # Test to_vtt_time
     # -------------------------------------------------------------------------
-    print("\n📋 to_vtt_time tests:")
+    section("to_vtt_time tests")
     
     test(to_vtt_time(0) == "00:00:00.000", "to_vtt_time(0)")
     test(to_vtt_time(1) == "00:00:01.000", "to_vtt_time(1)")
@@ -930,23 +1993,18 @@ def cmd_test():
     test(to_vtt_time(3661) == "01:01:01.000", "to_vtt_time(3661) = 1h1m1s")
     test(to_vtt_time(90.123) == "00:01:30.123", "to_vtt_time(90.123)")
     test(to_vtt_time(3600) == "01:00:00.000", "to_vtt_time(3600) = 1 hour")
+    test(to_vtt_time(1.001) == "00:00:01.001", "to_vtt_time(1.001) avoids float truncation")
+    test(to_vtt_time(1.9999) == "00:00:02.000", "to_vtt_time(1.9999) rounds into next second")
+    test(to_vtt_time(360000) == "100:00:00.000", "to_vtt_time(360000) = 100 hours")
+    
+    batch_input = [0, 1.5, 61, 90.123, 3661, 1.001, 1.9999]
+    test(to_vtt_time_batch(batch_input) == [to_vtt_time(s) for s in batch_input], "to_vtt_time_batch matches to_vtt_time")
+    test(to_vtt_time_batch([]) == [], "to_vtt_time_batch handles empty input")
     
     # -------------------------------------------------------------------------
     # Test VTT extraction (simulated Gemini response)
     # -------------------------------------------------------------------------
-    print("\n📋 VTT extraction tests:")
-    
-    # Simulate extract_vtt logic
-    def extract_vtt(text: str) -> str:
-        """Extract VTT portion from response text."""
-        if "WEBVTT" in text:
-            vtt_start = text.find("WEBVTT")
-            # Find end of VTT (usually marked by ```)
-            vtt_end = text.find("```", vtt_start)
-            if vtt_end == -1:
-                return text[vtt_start:]
-            return text[vtt_start:vtt_end].strip()
-        return text
+    section("VTT extraction tests")
     
     # Test cases
     raw1 = "Here is the VTT:\n```\nWEBVTT\n\n00:00.000 --> 00:05.000\nHello\n```\nDone!"
@@ -959,45 +2017,203 @@ def cmd_test():
     raw3 = "No VTT content here at all"
     test(extract_vtt(raw3) == raw3, "Returns original if no VTT found")
     
+    raw4 = "Log:\n```\nevent\n```\n\n```vtt\nWEBVTT\n\n00:00.000 --> 00:05.000\nA\n```"
+    test(extract_vtt(raw4) == "WEBVTT\n\n00:00.000 --> 00:05.000\nA", "Skips fenced blocks before the VTT")
+    test(extract_vtt(raw1.encode()) == extract_vtt(raw1).encode(), "Extracts VTT from bytes")
+    
+    # Streamed response: chunks written to a file, then matched over an mmap
+    chunks = [SimpleNamespace(text=raw1[i:i + 7]) for i in range(0, len(raw1), 7)]
+    chunks.append(SimpleNamespace(text=None, usage_metadata="usage"))
+    
+    class NoPartsChunk:
+        usage_metadata = None
+        
+        @property
+        def text(self):
+            raise ValueError("The response has no parts")
+    
+    chunks.insert(1, NoPartsChunk())
+    with tempfile.TemporaryFile() as f:
+        written, usage, reason = write_stream(chunks, f)
+        f.flush()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+            streamed_vtt = extract_vtt(raw)
+    test(written == len(raw1.encode()), "write_stream counts bytes written")
+    test(usage == "usage", "write_stream returns usage from the final chunk")
+    test(streamed_vtt == extract_vtt(raw1).encode(), "Extracts VTT from streamed response via mmap")
+    
+    blocked = SimpleNamespace(
+        text=None,
+        prompt_feedback=SimpleNamespace(block_reason=SimpleNamespace(name="SAFETY")),
+        candidates=[]
+    )
+    with tempfile.TemporaryFile() as f:
+        written, usage, reason = write_stream([blocked], f)
+    test(written == 0 and reason == "prompt blocked: SAFETY", "write_stream reports a blocked response", f"Got: {written}, {reason}")
+    
+    # -------------------------------------------------------------------------
+    # Test SRT conversion
+    # -------------------------------------------------------------------------
+    section("SRT conversion tests")
+    
+    srt = "\ufeff1\r\n00:00:01,500 --> 00:00:03,250\r\nHello, world\r\n\r\n2\r\n00:01:00,000 --> 00:01:02,000\r\nBye\r\n"
+    vtt = srt_to_vtt(srt)
+    test(vtt.startswith("WEBVTT\n\n1\n"), "srt_to_vtt adds WEBVTT header and strips BOM")
+    test("00:00:01.500 --> 00:00:03.250" in vtt, "srt_to_vtt converts timestamp commas")
+    test("Hello, world" in vtt, "srt_to_vtt keeps commas in cue text")
+    test("\r" not in vtt, "srt_to_vtt normalizes line endings")
+    
+    # -------------------------------------------------------------------------
+    # Test HTTP range parsing
+    # -------------------------------------------------------------------------
+    section("HTTP range tests")
+    
+    test(parse_byte_range("bytes=0-99", 1000) == (0, 99), "parse_byte_range('bytes=0-99')")
+    test(parse_byte_range("bytes=500-", 1000) == (500, 999), "parse_byte_range open-ended range")
+    test(parse_byte_range("bytes=-100", 1000) == (900, 999), "parse_byte_range suffix range")
+    test(parse_byte_range("bytes=900-5000", 1000) == (900, 999), "parse_byte_range clamps end to file size")
+    test(parse_byte_range("bytes=0-1,5-9", 1000) is None, "parse_byte_range ignores multi-range")
+    test(parse_byte_range("bytes=5-3", 1000) is None, "parse_byte_range ignores last < first")
+    try:
+        parse_byte_range("bytes=1000-", 1000)
+        unsatisfiable = False
+    except ValueError:
+        unsatisfiable = True
+    test(unsatisfiable, "parse_byte_range rejects range past end of file")
+    
+    # -------------------------------------------------------------------------
+    # Test cost estimation
+    # -------------------------------------------------------------------------
+    section("Cost estimation tests")
+    
+    full_cost = estimate_cost("gemini-3-pro-preview", 1_000_000, 0)
+    cached_cost = estimate_cost("gemini-3-pro-preview", 1_000_000, 0, cached_tok=1_000_000)
+    test(abs(full_cost - 2.00) < 1e-9, "estimate_cost bills 1M input at $2.00", f"Got: {full_cost}")
+    test(abs(cached_cost - 0.20) < 1e-9, "estimate_cost bills cached input at 10%", f"Got: {cached_cost}")
+    
+    # -------------------------------------------------------------------------
+    # Test downsample target selection
+    # -------------------------------------------------------------------------
+    section("Downsample target tests")
+    
+    test(pick_downsample_target(10_000_000) == DOWNSAMPLE_TARGETS[0], "High bitrate picks first target")
+    test(pick_downsample_target(1) == DOWNSAMPLE_TARGETS[-1], "Tiny bitrate falls back to last target")
+    test(fit_resolution(3840, 2160, 1920, 1080) == (1920, 1080), "fit_resolution scales 4K into 1080p")
+    test(fit_resolution(1440, 1080, 1280, 720) == (960, 720), "fit_resolution keeps 4:3 aspect ratio")
+    test(fit_resolution(640, 360, 1920, 1080) == (640, 360), "fit_resolution never upscales")
+    test(fit_resolution(1001, 1001, 1920, 1080) == (1000, 1000), "fit_resolution rounds to even dims")
+    
+    portrait = {"width": 1920, "height": 1080, "side_data_list": [{"side_data_type": "Display Matrix", "rotation": -90}]}
+    test(stream_rotation(portrait) == -90, "stream_rotation reads display matrix side data")
+    test(stream_rotation({"tags": {"rotate": "270"}}) == 270, "stream_rotation reads legacy rotate tag")
+    portrait_size = display_size(portrait["width"], portrait["height"], stream_rotation(portrait))
+    test(portrait_size == (1080, 1920), "display_size swaps dims for a rotated phone video", f"Got: {portrait_size}")
+    test(fit_resolution(*portrait_size, 1920, 1080) == (606, 1080), "Rotated source fits as portrait, not stretched")
+    test(display_size(1920, 1080, 180) == (1920, 1080), "display_size keeps dims for upside-down video")
+    
     # -------------------------------------------------------------------------
     # Test path handling
     # -------------------------------------------------------------------------
-    print("\n📋 Path handling tests:")
+    section("Path handling tests")
     
     test(BASE_DIR.exists(), "BASE_DIR exists")
     test(MEDIA_DIR.exists() or True, "MEDIA_DIR reference valid")  # May not exist
     test(CONFIG_FILE.suffix == ".json", "CONFIG_FILE is .json")
     
+    resolved = resolve_first_existing([BASE_DIR / "missing-file", CONFIG_FILE])
+    test(resolved is not None and resolved[0] == CONFIG_FILE, "resolve_first_existing skips missing candidates")
+    test(resolve_first_existing([BASE_DIR / "missing-file"]) is None, "resolve_first_existing returns None when nothing exists")
+    
+    with tempfile.TemporaryDirectory() as d:
+        (Path(d) / "real.mp4").touch()
+        (Path(d) / "clip.vtt").touch()
+        (Path(d) / "folder.mp4").mkdir()
+        os.symlink(Path(d) / "real.mp4", Path(d) / "linked.mp4")
+        videos, vtts = list_media_files(Path(d))
+    test(sorted(videos) == ["linked.mp4", "real.mp4"] and vtts == ["clip.vtt"], "list_media_files includes symlinked videos, not dirs", f"Got: {videos}, {vtts}")
+    
     # -------------------------------------------------------------------------
     # Test file size utility
     # -------------------------------------------------------------------------
-    print("\n📋 File size utility tests:")
-    
-    # Create temp file for testing
-    import tempfile
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.txt') as f:
-        f.write(b'x' * 1024 * 1024)  # 1MB
-        temp_path = Path(f.name)
+    section("File size utility tests")
     
-    try:
+    # Create temp file for testing (sparse: only st_size matters)
+    with tempfile.TemporaryDirectory() as d:
+        temp_path = Path(d) / "test.bin"
+        temp_path.touch()
+        os.truncate(temp_path, 1 << 20)  # 1MB
+        
         size_mb = get_file_size_mb(temp_path)
         test(0.9 < size_mb < 1.1, f"get_file_size_mb returns ~1.0 for 1MB file", f"Got: {size_mb}")
-    finally:
-        temp_path.unlink()
+        test(file_sha256(temp_path) == hashlib.sha256(bytes(1 << 20)).hexdigest(), "file_sha256 matches hashlib")
+    
+    # -------------------------------------------------------------------------
+    # Test output path allocation
+    # -------------------------------------------------------------------------
+    section("Output path tests")
+    
+    with tempfile.TemporaryDirectory() as d:
+        first = save_output(b"WEBVTT\n\n1", "clip", "vtt", Path(d))
+        second = save_output(b"WEBVTT\n\n2", "clip", "vtt", Path(d))
+        test(first.name == "clip.vtt", "save_output uses base name first", f"Got: {first.name}")
+        test(second.name == "clip-1.vtt", "save_output never overwrites an existing output", f"Got: {second.name}")
+        test(first.read_bytes() == b"WEBVTT\n\n1", "save_output publishes complete contents")
+        test(sorted(p.name for p in Path(d).iterdir()) == ["clip-1.vtt", "clip.vtt"], "save_output leaves no temp files")
+        
+        (Path(d) / "clip-3.vtt").touch()
+        (Path(d) / "clip-2.log").touch()
+        third = save_output(b"", "clip", "vtt", Path(d))
+        test(third.name == "clip-2.vtt", "save_output fills the first free number", f"Got: {third.name}")
+        
+        atomic_write_text(first, "WEBVTT\n")
+        test(first.read_text(encoding="utf-8") == "WEBVTT\n", "atomic_write_text replaces existing file")
+    
+    with tempfile.TemporaryDirectory() as d:
+        dir_fd = open_dir(Path(d))
+        try:
+            path = save_output(b"WEBVTT\n", "clip", "vtt", Path(d), None, dir_fd)
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        test(path.read_bytes() == b"WEBVTT\n", "save_output writes relative to a directory fd")
+        test([p.name for p in Path(d).iterdir()] == ["clip.vtt"], "Directory fd writes leave no temp files")
+    
+    def no_links(*args, **kwargs):
+        raise PermissionError(errno.EPERM, "Operation not permitted")
+    
+    with tempfile.TemporaryDirectory() as d:
+        real_link, os.link = os.link, no_links  # As on FAT32/exFAT
+        try:
+            first = save_output(b"WEBVTT\n\n1", "clip", "vtt", Path(d))
+            second = save_output(b"WEBVTT\n\n2", "clip", "vtt", Path(d))
+        finally:
+            os.link = real_link
+        test(first.read_bytes() == b"WEBVTT\n\n1" and second.name == "clip-1.vtt", "save_output copies when hard links are unsupported", f"Got: {second.name}")
+        test(sorted(p.name for p in Path(d).iterdir()) == ["clip-1.vtt", "clip.vtt"], "Copy fallback leaves no temp files")
     
     # -------------------------------------------------------------------------
     # Test config loading
     # -------------------------------------------------------------------------
-    print("\n📋 Config loading tests:")
+    section("Config loading tests")
     
     test("gemini" in CONFIG, "CONFIG has 'gemini' section")
     test("video" in CONFIG, "CONFIG has 'video' section")
     test("files" in CONFIG, "CONFIG has 'files' section")
     test(isinstance(CONFIG["gemini"]["model"], str), "gemini.model is string")
+    test(CFG.gemini.model == CONFIG["gemini"]["model"], "CFG mirrors CONFIG")
+    test(load_config() is CONFIG, "load_config is memoized")
+    
+    prompt_file = BASE_DIR / PROMPT_FILE
+    if prompt_file.exists():
+        mtime_ns = prompt_file.stat().st_mtime_ns
+        prompt = _load_prompt(str(prompt_file), mtime_ns)
+        test("{{THINKING_LEVEL}}" not in prompt, "Prompt has THINKING_LEVEL injected")
+        test(_load_prompt(str(prompt_file), mtime_ns) is prompt, "Prompt is memoized per path and mtime")
     
     # -------------------------------------------------------------------------
     # Summary
     # -------------------------------------------------------------------------
+    sys.stdout.write("\n".join(lines) + "\n")
     print("\n" + "=" * 60)
     print(f"📊 Results: {passed} passed, {failed} failed")
     print("=" * 60)
@@ -1037,6 +2253,8 @@ Examples:
                         help="Convert video file to enhanced VTT")
     parser.add_argument("--output-vtt", metavar="FILE",
                         help="Output VTT filename (for --convert)")
+    parser.add_argument("--no-parallel", action="store_true",
+                        help="Run --convert steps sequentially (for debugging)")
     parser.add_argument("--test", action="store_true",
                         help="Run unit tests")
     parser.add_argument("--version", action="version",
@@ -1053,7 +2271,7 @@ Examples:
     elif args.check:
         cmd_check()
     elif args.convert:
-        cmd_convert(args.convert, args.output_vtt)
+        cmd_convert(args.convert, args.output_vtt, parallel=not args.no_parallel)
     elif args.serve:
         cmd_serve(args.port)
 